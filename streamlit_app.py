@@ -1,9 +1,15 @@
 import streamlit as st
 import requests
-import json
+import orjson
 import re
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, parse_qs, urlparse
+import html
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Page config
 st.set_page_config(
@@ -12,12 +18,68 @@ st.set_page_config(
     layout="centered"
 )
 
+# Default headers sent with every request to VK
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Referer': 'https://vk.com/',
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+# Precompiled regex patterns
+_VIDEO_ID_PATTERNS = [
+    re.compile(r'video(-?\d+_\d+)'),  # Standard video URL pattern
+    re.compile(r'video_ext.php\?oid=(-?\d+)&id=(\d+)'),  # External video URL pattern
+]
+_JSON_EMBED_RE = re.compile(r'<!json>(.+?)<!>')
+_URL_QUALITY_RE = re.compile(r'"url(\d+)":"([^"]+)"')
+_COOKIE_RE = re.compile(r'([^=;\s]+)=([^;]*)')
+_TITLE_RE = re.compile(
+    r'<div[^>]*class="[^"]*\b(?:mv_title|VideoPageInfoRow__title)\b[^"]*"[^>]*>(.*?)</div>',
+    re.I | re.S
+)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Cookie persistence is opt-in and meant for a local, single-user install only:
+# the file is shared by every session on the server, so never enable it on a
+# public deployment.
+PERSIST_COOKIES = os.environ.get('VK_DL_PERSIST_COOKIES') == '1'
+COOKIES_FILE = Path.home() / '.vk_dl' / 'cookies.json'
+
+def load_saved_cookies():
+    """Load cookies saved by a previous session, if persistence is enabled."""
+    if not PERSIST_COOKIES:
+        return None
+    try:
+        cookies = orjson.loads(COOKIES_FILE.read_bytes())
+        return cookies if isinstance(cookies, dict) and cookies else None
+    except (OSError, ValueError):
+        return None
+
+def save_cookies(cookies):
+    """Persist cookies to disk, or remove the saved file when cleared."""
+    if not PERSIST_COOKIES:
+        return
+    try:
+        if cookies:
+            COOKIES_FILE.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            COOKIES_FILE.parent.chmod(0o700)
+            # Create the file owner-only; fchmod also tightens an existing file
+            # before anything is written to it
+            fd = os.open(COOKIES_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), 0o600)
+                f.write(orjson.dumps(cookies))
+        else:
+            COOKIES_FILE.unlink(missing_ok=True)
+    except OSError as e:
+        st.warning(f"Could not persist cookies: {str(e)}")
+
 # Initialize session state for cookies
 if 'vk_cookies' not in st.session_state:
-    st.session_state.vk_cookies = None
+    st.session_state.vk_cookies = load_saved_cookies()
 
 # Custom CSS
-st.markdown("""
+_CSS = """
 <style>
 .main {
     padding: 2rem;
@@ -52,45 +114,94 @@ st.markdown("""
     border-radius: 4px;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource
+def _inject_css():
+    """Emit the custom CSS; cached so the markdown call is not rebuilt on every rerun."""
+    st.markdown(_CSS, unsafe_allow_html=True)
+    return True
+
+_inject_css()
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 def format_size(size_bytes):
     """Format file size in bytes to human readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.2f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.2f} TB"
+    if size_bytes <= 0:
+        return "0.00 B"
+    # Pick the unit from the bit length (each unit is 2**10 of the previous)
+    index = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * index)):.2f} {_SIZE_UNITS[index]}"
+
+def get_session():
+    """Get the pooled HTTP session for this user, creating it on first use.
+
+    The session lives in st.session_state so that keep-alive connections are
+    reused across reruns while cookies stay private to each user.
+    """
+    if 'vk_session' not in st.session_state:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=2, backoff_factor=0.3)
+        )
+        session.mount('https://', adapter)
+        if st.session_state.vk_cookies:
+            session.cookies.update(st.session_state.vk_cookies)
+        st.session_state.vk_session = session
+    return st.session_state.vk_session
+
+def set_session_cookies(cookies):
+    """Replace the cookies held by the pooled session."""
+    session = get_session()
+    session.cookies.clear()
+    if cookies:
+        session.cookies.update(cookies)
 
 def get_file_size(url, session):
-    """Get file size using HEAD request."""
+    """Get file size using a single-byte range request."""
     try:
-        response = session.head(url)
+        response = session.get(
+            url,
+            headers={'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'},
+            stream=True,
+            timeout=5
+        )
+        if response.status_code == 206:
+            # Read the 1-byte body so the connection returns to the pool
+            try:
+                response.content
+            except Exception:
+                response.close()
+        else:
+            # Range was ignored; don't download the whole file
+            response.close()
+
         if response.ok:
+            # Content-Range looks like "bytes 0-0/TOTAL"
+            content_range = response.headers.get('Content-Range', '')
+            if '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                if total.isdigit():
+                    return int(total)
             return int(response.headers.get('content-length', 0))
     except:
         pass
     return 0
 
 def parse_cookies(cookie_string):
-    """Parse cookie string into a dictionary."""
-    cookies = {}
-    if cookie_string:
-        pairs = cookie_string.split(';')
-        for pair in pairs:
-            key, value = pair.strip().split('=', 1)
-            cookies[key] = value
-    return cookies
+    """Parse cookie string into a dictionary, skipping pairs without '='."""
+    if not cookie_string:
+        return {}
+    return {key: value.strip() for key, value in _COOKIE_RE.findall(cookie_string)}
 
 def extract_video_id(url):
     """Extract video ID from VK video URL."""
-    patterns = [
-        r'video(-?\d+_\d+)',  # Standard video URL pattern
-        r'video_ext.php\?oid=(-?\d+)&id=(\d+)',  # External video URL pattern
-    ]
-
-    for pattern in patterns:
-        match = re.search(pattern, url)
+    for pattern in _VIDEO_ID_PATTERNS:
+        match = pattern.search(url)
         if match:
             if len(match.groups()) == 1:
                 return match.group(1)
@@ -98,7 +209,7 @@ def extract_video_id(url):
                 return f"{match.group(1)}_{match.group(2)}"
     return None
 
-def parse_video_data(json_data, session):
+def parse_video_data(json_data):
     """Parse video data from JSON response similar to userscript."""
     try:
         # Find the video player data
@@ -122,20 +233,23 @@ def parse_video_data(json_data, session):
 
         params = player['params'][0]
 
-        # Extract video sources
+        # Group video sources by quality in one pass, preferring urlXXX
+        # over cacheXXX when both exist
+        urls_by_quality = {}
+        for key, value in params.items():
+            if key[:3] == 'url' and key[3:].isdigit():
+                urls_by_quality[key[3:]] = value
+            elif key[:5] == 'cache' and key[5:].isdigit():
+                urls_by_quality.setdefault(key[5:], value)
+
+        # Sizes are probed on demand from the UI
         sources = {}
-        for key in params:
-            # Look for both url and cache patterns
-            if key.startswith('url') or key.startswith('cache'):
-                quality = key.replace('url', '').replace('cache', '')
-                if quality.isdigit():
-                    url = params[key]
-                    size = get_file_size(url, session)
-                    sources[f"mp4_{quality}"] = {
-                        'url': url,
-                        'size': size,
-                        'size_formatted': format_size(size)
-                    }
+        for quality, url in urls_by_quality.items():
+            sources[f"mp4_{quality}"] = {
+                'url': url,
+                'size': None,
+                'size_formatted': '—'
+            }
 
         # Extract HLS stream if available
         if params.get('hls'):
@@ -152,131 +266,190 @@ def parse_video_data(json_data, session):
         st.error(f"Error parsing video data: {str(e)}")
         return None
 
-def get_video_info(url):
-    """Get video information by parsing the video page."""
-    try:
-        # Common headers
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://vk.com/',
+class VideoInfoError(Exception):
+    """Raised when video info cannot be fetched; the message is shown to the user."""
+
+def load_file_size(size_key, url):
+    """Probe a file size on demand and remember it in session state.
+
+    Failed probes are only flagged, so the button stays available for a retry.
+    """
+    size = get_file_size(url, get_session())
+    if size > 0:
+        st.session_state[size_key] = size
+        st.session_state.pop(f"{size_key}_failed", None)
+    else:
+        st.session_state[f"{size_key}_failed"] = True
+
+def cookie_fingerprint(cookies):
+    """Hash cookies into a short string usable as a cache key."""
+    if not cookies:
+        return ''
+    return hashlib.blake2b(repr(sorted(cookies.items())).encode(), digest_size=16).hexdigest()
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _fetch_video_info_cached(video_id, cookies_key, _session):
+    """Fetch video info for a video ID.
+
+    Cached on the video ID and cookie fingerprint; the session is excluded
+    from the cache key. Failures raise VideoInfoError so they are not cached.
+    """
+    session = _session
+
+    # Make request to al_video.php
+    data = {
+        'act': 'show',
+        'al': 1,
+        'video': video_id,
+        'autoplay': 0,
+        'module': '',
+        'list': ''
+    }
+
+    response = session.post(
+        'https://vk.com/al_video.php',
+        data=data,
+        headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
             'X-Requested-With': 'XMLHttpRequest'
         }
+    )
 
-        # Create session to maintain cookies
-        session = requests.Session()
-        session.headers.update(headers)
+    if not response.ok:
+        raise VideoInfoError("Failed to fetch video info")
 
-        # Add cookies if available
-        if st.session_state.vk_cookies:
-            session.cookies.update(st.session_state.vk_cookies)
+    try:
+        # orjson only reads UTF-8 bytes; decode other charsets (VK often
+        # serves windows-1251) with the encoding the server declared
+        encoding = (response.encoding or 'utf-8').lower().replace('_', '-')
+        if encoding in ('utf-8', 'utf8'):
+            json_data = orjson.loads(response.content)
+        else:
+            json_data = orjson.loads(response.text)
+    except:
+        # Try parsing embedded JSON from HTML response
+        json_match = _JSON_EMBED_RE.search(response.text)
+        if json_match:
+            json_data = orjson.loads(json_match.group(1))
+        else:
+            raise VideoInfoError("Could not parse server response")
 
-        # Get video ID
-        video_id = extract_video_id(url)
-        if not video_id:
-            st.error("Could not extract video ID from URL")
-            return None
+    video_info = parse_video_data(json_data)
+    if not video_info:
+        # Fallback to parsing page HTML if API fails
+        response = session.get(f"https://vk.com/video{video_id}")
+        if not response.ok:
+            raise VideoInfoError("Failed to fetch video page")
 
-        # Make request to al_video.php
-        data = {
-            'act': 'show',
-            'al': 1,
-            'video': video_id,
-            'autoplay': 0,
-            'module': '',
-            'list': ''
-        }
+        # Find video title
+        title_match = _TITLE_RE.search(response.text)
+        title = html.unescape(_TAG_RE.sub('', title_match.group(1))).strip() if title_match else ''
+        title = title or "Untitled Video"
+
+        # Find video sources
+        sources = {}
 
-        response = session.post(
-            'https://vk.com/al_video.php',
-            data=data,
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'X-Requested-With': 'XMLHttpRequest'
+        # Try to find video data in page source
+        video_data_match = _URL_QUALITY_RE.search(response.text)
+        if video_data_match:
+            quality = video_data_match.group(1)
+            video_url = video_data_match.group(2).replace('\\', '')
+            sources[f"mp4_{quality}"] = {
+                'url': video_url,
+                'size': None,
+                'size_formatted': '—'
             }
-        )
 
-        if not response.ok:
-            st.error("Failed to fetch video info")
-            return None
+        # Don't cache an empty result; it may be a transient failure
+        if not sources:
+            raise VideoInfoError(
+                "No download links found. The video might be private or deleted; "
+                "if it is private, try adding your VK cookies above."
+            )
 
-        try:
-            json_data = response.json()
-        except:
-            # Try parsing embedded JSON from HTML response
-            json_match = re.search(r'<!json>(.+?)<!>', response.text)
-            if json_match:
-                json_data = json.loads(json_match.group(1))
-            else:
-                st.error("Could not parse server response")
-                return None
-
-        video_info = parse_video_data(json_data, session)
-        if not video_info:
-            # Fallback to parsing page HTML if API fails
-            response = session.get(url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Find video title
-            title_elem = soup.find('div', {'class': 'mv_title'}) or soup.find('div', {'class': 'VideoPageInfoRow__title'})
-            title = title_elem.text.strip() if title_elem else "Untitled Video"
-
-            # Find video sources
-            sources = {}
-
-            # Try to find video data in page source
-            video_data_match = re.search(r'"url(\d+)":"([^"]+)"', response.text)
-            if video_data_match:
-                quality = video_data_match.group(1)
-                video_url = video_data_match.group(2).replace('\\', '')
-                size = get_file_size(video_url, session)
-                sources[f"mp4_{quality}"] = {
-                    'url': video_url,
-                    'size': size,
-                    'size_formatted': format_size(size)
-                }
-
-            video_info = {
-                "title": title,
-                "files": sources
-            }
+        video_info = {
+            "title": title,
+            "files": sources
+        }
 
-        return video_info
+    return video_info
 
+def get_video_info(url):
+    """Get video information by parsing the video page."""
+    # Get video ID
+    video_id = extract_video_id(url)
+    if not video_id:
+        st.error("Could not extract video ID from URL")
+        return None
+
+    try:
+        return _fetch_video_info_cached(
+            video_id,
+            cookie_fingerprint(st.session_state.vk_cookies),
+            get_session()
+        )
+    except VideoInfoError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Error fetching video info: {str(e)}")
         return None
 
+def _watch_progress(filename, total_size, progress_bar, done):
+    """Update the progress bar from the size of the file being written."""
+    last_progress = 0
+    while not done.wait(0.5):
+        try:
+            downloaded = os.path.getsize(filename)
+        except OSError:
+            continue
+        # Only update the widget when the percentage changes
+        progress = min(int((downloaded / total_size) * 100), 100)
+        if progress != last_progress:
+            progress_bar.progress(progress / 100)
+            last_progress = progress
+
 def download_video(url, filename):
     """Download video from URL."""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://vk.com/',
-            'X-Requested-With': 'XMLHttpRequest'
-        }
-
-        # Create session with cookies if available
-        session = requests.Session()
-        session.headers.update(headers)
-        if st.session_state.vk_cookies:
-            session.cookies.update(st.session_state.vk_cookies)
+        session = get_session()
 
-        response = session.get(url, stream=True)
+        # Video files are not compressed; skip the decoding layer
+        response = session.get(url, stream=True, headers={'Accept-Encoding': 'identity'})
         response.raise_for_status()
+        response.raw.decode_content = True
 
         total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024
+        block_size = 1 << 20
         progress_bar = st.progress(0)
 
-        with open(filename, 'wb') as f:
-            downloaded = 0
-            for data in response.iter_content(block_size):
-                f.write(data)
-                downloaded += len(data)
-                if total_size:
-                    progress = int((downloaded / total_size) * 100)
-                    progress_bar.progress(progress / 100)
+        # Copy in C via copyfileobj; progress is polled from a separate thread
+        done = threading.Event()
+        watcher = None
+        if total_size:
+            # Non-public Streamlit API; without it we only lose live progress
+            try:
+                from streamlit.runtime.scriptrunner import add_script_run_ctx
+            except ImportError:
+                add_script_run_ctx = None
+            if add_script_run_ctx:
+                watcher = threading.Thread(
+                    target=_watch_progress,
+                    args=(filename, total_size, progress_bar, done),
+                    daemon=True
+                )
+                add_script_run_ctx(watcher)
+                watcher.start()
 
+        try:
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=block_size)
+        finally:
+            done.set()
+            if watcher:
+                watcher.join()
+
+        progress_bar.progress(1.0)
         return True
     except Exception as e:
         st.error(f"Error downloading video: {str(e)}")
@@ -303,9 +476,13 @@ with st.expander("🔐 Add VK Cookies (Optional - Required for private videos)")
     if st.button("Save Cookies"):
         if cookie_input:
             st.session_state.vk_cookies = parse_cookies(cookie_input)
+            set_session_cookies(st.session_state.vk_cookies)
+            save_cookies(st.session_state.vk_cookies)
             st.success("Cookies saved successfully!")
         else:
             st.session_state.vk_cookies = None
+            set_session_cookies(None)
+            save_cookies(None)
             st.info("Cookies cleared.")
 
 # Input field for video URL
@@ -327,16 +504,35 @@ if video_url:
         if available_qualities:
             st.write("### Available Qualities")
 
+            video_id = extract_video_id(video_url)
             for quality, info in available_qualities.items():
+                quality_label = quality.replace('mp4_', '')
+                size_key = f"size_{video_id}_{quality_label}"
+                if size_key in st.session_state:
+                    size_formatted = format_size(st.session_state[size_key])
+                elif st.session_state.get(f"{size_key}_failed"):
+                    size_formatted = 'unknown'
+                else:
+                    size_formatted = info['size_formatted']
+
                 with st.container():
                     st.markdown(f"""
                     <div class="quality-info">
-                        <h4>{quality.replace('mp4_', '')}p</h4>
-                        <p>Size: {info['size_formatted']}</p>
-                        <a href="{info['url']}" class="download-link" target="_blank">Download {quality.replace('mp4_', '')}p</a>
+                        <h4>{quality_label}p</h4>
+                        <p>Size: {size_formatted}</p>
+                        <a href="{info['url']}" class="download-link" target="_blank">Download {quality_label}p</a>
                     </div>
                     """, unsafe_allow_html=True)
 
+                    # Probe the size only when asked for
+                    if size_key not in st.session_state:
+                        st.button(
+                            f"Show size for {quality_label}p",
+                            key=f"btn_{size_key}",
+                            on_click=load_file_size,
+                            args=(size_key, info['url'])
+                        )
+
                     # Also show copyable URL
                     st.code(info['url'], language=None)
         else: